@@ -1,12 +1,27 @@
 # app.py
+import atexit
 import os
+import gzip
+import hashlib
+import html
 import json
+import re
+import tempfile
 import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import requests
 import streamlit as st
-import plotly.express as px
+import streamlit.components.v1 as components
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # необязательная зависимость: C-парсер JSON, заметно быстрее stdlib
+except ImportError:
+    orjson = None
 
 from config import (
     PLAYLISTS,
@@ -53,6 +68,12 @@ LLM_PROVIDER = (_get_secret("LLM_PROVIDER") or "deepseek").lower()
 OPENAI_API_KEY = _get_secret("OPENAI_API_KEY")
 OPENAI_BASE_URL = _get_secret("OPENAI_BASE_URL")  # можно оставить пустым для официального OpenAI
 
+# модель выбранного провайдера
+if LLM_PROVIDER == "deepseek":
+    LLM_MODEL = DEEPSEEK_CONFIG.get("model", "deepseek-chat")
+else:
+    LLM_MODEL = os.getenv("LLM_MODEL") or "gpt-4o-mini"
+
 # DeepSeek может быть пустым, если используем другой провайдер
 DEEPSEEK_ENABLED = bool(DEEPSEEK_API_KEY) or (LLM_PROVIDER != "deepseek")
 
@@ -68,33 +89,64 @@ else:
     if not OPENAI_API_KEY:
         st.warning("OPENAI_API_KEY не задан (для LLM_PROVIDER=openai). Генерация может быть недоступна.")
 
-# MathJax
-st.markdown(
-    """
-<script src="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.5/MathJax.js?config=TeX-MML-AM_CHTML"></script>
+# MathJax: st.markdown не исполняет <script>, поэтому грузим его через компонент прямо в
+# документ приложения; сам скрипт грузится один раз за жизнь вкладки (повторные rerun'ы видят метку и выходят).
+# Typeset не дёргается на каждый rerun: MutationObserver копит изменения DOM и
+# запускает одну перевёрстку после 50 мс тишины, в idle-время браузера.
+# Строка сырая: JS должен получить '\\(' — иначе разделителем формулы станет любая скобка.
+# Верстаются только markdown-блоки основной области (текст урока, вопросы, варианты,
+# задания, подсказки), а не весь документ: сайдбар и служебные элементы MathJax не трогает.
+_MATHJAX_HTML = r"""
 <script>
-  MathJax.Hub.Config({
-    tex2jax: { inlineMath: [['\\(', '\\)']], displayMath: [['\\[', '\\]']], processEscapes: true }
+(function () {
+  const win = window.parent, doc = win.document;
+  if (doc.getElementById("tutor-mathjax")) return;
+
+  win.MathJax = {
+    tex: { inlineMath: [['\\(', '\\)']], displayMath: [['\\[', '\\]']], processEscapes: true },
+    // вёрстку ведёт typeset() ниже; после загрузки — один проход по уже выведенной странице
+    startup: { typeset: false, ready: () => { win.MathJax.startup.defaultReady(); typeset(); } },
+  };
+  const script = doc.createElement("script");
+  script.id = "tutor-mathjax";
+  script.async = true;
+  script.src = "https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js";
+  doc.head.appendChild(script);
+
+  const root = doc.querySelector('[data-testid="stAppViewContainer"]') || doc.body;
+  const CONTENT = '[data-testid="stMain"] [data-testid="stMarkdownContainer"], '
+    + 'section.main [data-testid="stMarkdownContainer"]';
+  const idle = win.requestIdleCallback || ((fn) => win.setTimeout(fn, 0));
+  let timer = null;
+  const observer = new win.MutationObserver(() => {
+    if (timer) win.clearTimeout(timer);
+    timer = win.setTimeout(() => idle(typeset), 50);
   });
-  MathJax.Hub.Queue(["Typeset", MathJax.Hub]);
+  const watch = () => observer.observe(root, { childList: true, subtree: true, characterData: true });
+  function typeset() {
+    timer = null;
+    if (!win.MathJax || !win.MathJax.typesetPromise) return;
+    const nodes = Array.from(root.querySelectorAll(CONTENT));
+    if (!nodes.length) return;
+    // собственные правки MathJax не должны снова будить observer
+    observer.disconnect();
+    // узлы, удалённые Streamlit при rerun, MathJax 3 иначе держит в своём списке формул
+    win.MathJax.typesetClear();
+    win.MathJax.typesetPromise(nodes).then(watch, watch);
+  }
+  watch();
+})();
 </script>
-""",
-    unsafe_allow_html=True,
-)
+"""
 
 # CSS
-st.markdown(
-    """
+_CSS_HTML = """
 <style>
   .main-header {
     text-align:center; padding:2rem;
     background:linear-gradient(90deg,#667eea 0%,#764ba2 100%);
     border-radius:10px; color:#fff; margin-bottom:2rem;
   }
-  .progress-card { background:#fff; padding:1.5rem; border-radius:10px;
-    box-shadow:0 2px 8px rgba(0,0,0,0.1); margin:1rem 0; }
-  .task-card { background:#f8f9fa; padding:1.5rem; border-radius:8px;
-    border-left:4px solid #007bff; margin:1rem 0; }
   .success-animation { animation:pulse 0.5s ease-in-out; }
   @keyframes pulse { 0%{transform:scale(1);} 50%{transform:scale(1.05);} 100%{transform:scale(1);} }
   .difficulty-badge { display:inline-block; padding:.3rem .8rem; border-radius:15px;
@@ -105,92 +157,249 @@ st.markdown(
   .notebook-note{ background:#e9f7ef; padding:1rem; border-radius:8px; margin-bottom:1rem; border-left:4px solid #28a745; }
   .badge{ display:inline-block; padding:.25rem .5rem; border-radius:6px; font-size:.75rem; font-weight:600; }
   .badge-green{ background:#d1fae5; color:#065f46; } .badge-gray{ background:#e5e7eb; color:#374151; }
+  .result-ok, .result-bad{ padding:.6rem 1rem; border-radius:8px; margin-bottom:.5rem; }
+  .result-ok{ background:#d4edda; color:#155724; } .result-bad{ background:#f8d7da; color:#721c24; }
+  .result-bad small{ display:block; color:#374151; margin-top:.25rem; }
 </style>
-""",
-    unsafe_allow_html=True,
+"""
+
+
+def _inject_static_assets():
+    """
+    Статика страницы. Вызывается на каждом rerun: элементы, не выведенные в очередном
+    прогоне, Streamlit удаляет со страницы, поэтому «вывести один раз за сессию» нельзя.
+    """
+    components.html(_MATHJAX_HTML, height=0)
+    st.markdown(_CSS_HTML, unsafe_allow_html=True)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# HTTP-сессии: одна на хост, живут между rerun'ами (keep-alive, без повторного TLS-рукопожатия)
+# Политики повторов неизменяемы (urllib3 копирует Retry на каждую попытку) — общие константы
+# Повторы DeepSeek целиком на адаптере: бэкофф, Retry-After и то же пуловое соединение.
+# retry_attempts в конфиге — число попыток, Retry считает только повторы.
+# raise_on_status=False: после последнего повтора приходит сам ответ, и его код разбирает call_llm.
+_DS_RETRY = Retry(
+    total=max(0, DEEPSEEK_CONFIG.get("retry_attempts", 3) - 1),
+    backoff_factor=1.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+_YT_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(["GET"]),
 )
+_USER_AGENT = "Tuitor-AI/1.0 (+streamlit)"
+
+
+@st.cache_resource(show_spinner=False)
+def _deepseek_session() -> requests.Session:
+    sess = requests.Session()
+    sess.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=_DS_RETRY))
+    # постоянные заголовки задаём один раз — запросы передают только то, что меняется
+    sess.headers.update({
+        "User-Agent": _USER_AGENT,
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json",
+    })
+    atexit.register(sess.close)
+    return sess
+
+
+@st.cache_resource(show_spinner=False)
+def _youtube_session() -> requests.Session:
+    sess = requests.Session()
+    sess.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=_YT_RETRY))
+    sess.headers["User-Agent"] = _USER_AGENT
+    atexit.register(sess.close)
+    return sess
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client():
+    """Один клиент на процесс: внутри у него свой пул соединений (httpx)."""
+    from openai import OpenAI  # требует пакет openai
+
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None)
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # LLM клиент с backoff
-def call_llm(prompt: str) -> dict:
+def _json_loads(raw):
+    """json.loads через orjson, если он установлен (его JSONDecodeError — подкласс stdlib)."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_dumps(obj) -> bytes:
+    """Тело запроса в UTF-8; orjson заметно быстрее на длинных промптах."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _iter_deepseek_stream(resp):
+    """Куски текста из SSE-кадров DeepSeek (`data: {...}` … `data: [DONE]`) по мере прихода."""
+    # байты декодируем сами: для text/event-stream без charset requests считает кодировку latin-1
+    for line in resp.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        chunk = line[5:].strip()
+        if chunk == b"[DONE]":
+            break
+        try:
+            delta = _json_loads(chunk)["choices"][0].get("delta") or {}
+        except (json.JSONDecodeError, KeyError, IndexError):
+            continue
+        if delta.get("content"):
+            yield delta["content"]
+
+
+def _read_deepseek_stream(resp) -> str:
+    return "".join(_iter_deepseek_stream(resp))
+
+
+# JSON-режим API: сервер гарантирует синтаксически валидный объект. Условие — слово
+# "JSON" в самом промпте (оно есть в общих инструкциях ниже).
+_JSON_MODE = {"type": "json_object"}
+
+
+def _parse_llm_content(content, expect_json: bool) -> dict:
+    """
+    Разбор ответа модели: как есть, без ```-ограды, затем по внешним { … } — если модель
+    окружила JSON пояснениями. Спасённый ответ дешевле повторной генерации.
+    """
+    content = content or ""
+    if not expect_json:
+        return {"content": content}
+    stripped = content.strip()
+    start, end = stripped.find("{"), stripped.rfind("}")
+    candidates = (
+        stripped,
+        stripped.removeprefix("```json").removeprefix("```").removesuffix("```"),
+        stripped[start:end + 1] if 0 <= start < end else "",
+    )
+    # без ограды второй кандидат совпадает с первым — один и тот же текст не разбираем дважды
+    for candidate in dict.fromkeys(candidates):
+        if not candidate:
+            continue
+        try:
+            data = _json_loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        # ниже везде ждут объект; голый список/строка — тот же брак, что и невалидный JSON
+        if isinstance(data, dict):
+            return data
+    return {"error": "bad_json", "raw": content}
+
+
+def call_llm(
+    prompt: str,
+    stream: bool = False,
+    max_tokens: int | None = None,
+    expect_json: bool = True,
+    schema: dict | None = None,
+) -> dict:
     """
     Возвращает:
-      - dict с JSON-ответом, если модель вернула JSON
-      - {"content": "..."} если пришёл plain-text
-      - {"error": "..."} при ошибке
+      - dict с JSON-ответом (expect_json=True)
+      - {"content": "..."} для текстовых ответов (expect_json=False)
+      - {"error": "..."} при ошибке, в т.ч. {"error": "bad_json", "raw": "..."}
+
+    stream=True — DeepSeek отдаёт ответ по кускам (SSE); таймаут тогда ограничивает паузу
+    между кусками, а не всю генерацию, и длинные ответы не обрываются по timeout.
+    schema — JSON Schema ответа: OpenAI-совместимый провайдер получает её как строгий
+    structured output; DeepSeek схем не поддерживает и остаётся в режиме json_object.
     """
+    if not DEEPSEEK_ENABLED:
+        return {"error": "llm_disabled"}
     # общий таймаут/ретраи
     retry_attempts = DEEPSEEK_CONFIG.get("retry_attempts", 4)
     timeout_s = DEEPSEEK_CONFIG.get("timeout", 60)
     temperature = DEEPSEEK_CONFIG.get("temperature", 0.7)
-    max_tokens = DEEPSEEK_CONFIG.get("max_tokens", 1800)
-    model = DEEPSEEK_CONFIG.get("model", "deepseek-chat")
+    max_tokens = max_tokens or DEEPSEEK_CONFIG.get("max_tokens", 1800)
 
     if LLM_PROVIDER == "deepseek":
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json",
-        }
+        # авторизация и Content-Type — в заголовках сессии
+        headers = {}
         payload = {
-            "model": model,
+            "model": LLM_MODEL,
             "messages": [{"role": "user", "content": prompt}],
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
+        if stream:
+            payload["stream"] = True
+        if expect_json:
+            payload["response_format"] = _JSON_MODE
         url = "https://api.deepseek.com/v1/chat/completions"
-
-        for attempt in range(retry_attempts):
-            try:
-                resp = requests.post(url, headers=headers, json=payload, timeout=timeout_s)
+        # сериализуем один раз — повторные попытки шлют те же байты
+        body = _json_dumps(payload)
+        # сжатие тела — только если endpoint его принимает (флаг в конфиге, по умолчанию выключен)
+        if DEEPSEEK_CONFIG.get("compress_requests") and len(body) > 1024:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+
+        # повторы (429/5xx, обрывы, таймауты) делает адаптер сессии — см. _DS_RETRY
+        try:
+            resp = _deepseek_session().post(url, headers=headers, data=body, timeout=timeout_s, stream=stream)
+            with resp:
                 if resp.status_code == 402:
                     st.warning("DeepSeek вернул 402 (недостаточно средств).")
                     return {"error": "402"}
                 resp.raise_for_status()
-                data = resp.json()
-                content = data["choices"][0]["message"]["content"]
-                try:
-                    return json.loads(content)
-                except json.JSONDecodeError:
-                    return {"content": content}
-            except requests.exceptions.Timeout:
-                if attempt == retry_attempts - 1:
-                    st.error("Превышено время ожидания ответа от DeepSeek API")
-                    return {"error": "timeout"}
-                time.sleep(0.5 * (2 ** attempt))
-            except requests.exceptions.HTTPError as e:
-                if attempt == retry_attempts - 1:
-                    st.error(f"Ошибка HTTP DeepSeek API: {e.response.status_code}")
-                    return {"error": str(e)}
-                time.sleep(0.5 * (2 ** attempt))
-            except Exception as e:
-                if attempt == retry_attempts - 1:
-                    st.error(f"Ошибка API DeepSeek: {str(e)}")
-                    return {"error": str(e)}
-                time.sleep(0.5 * (2 ** attempt))
-        return {"error": "unknown"}
+                if stream:
+                    content = _read_deepseek_stream(resp)
+                else:
+                    content = _json_loads(resp.content)["choices"][0]["message"]["content"]
+            return _parse_llm_content(content, expect_json)
+        except requests.exceptions.Timeout:
+            st.error("Превышено время ожидания ответа от DeepSeek API")
+            return {"error": "timeout"}
+        except requests.exceptions.HTTPError as e:
+            st.error(f"Ошибка HTTP DeepSeek API: {e.response.status_code}")
+            return {"error": str(e)}
+        except Exception as e:
+            st.error(f"Ошибка API DeepSeek: {str(e)}")
+            return {"error": str(e)}
 
     # OpenAI-совместимый провайдер (ChatGPT, Grok через совместимый endpoint и т.п.)
     try:
-        from openai import OpenAI  # требует пакет openai
-    except Exception:
+        client = _openai_client()
+    except ImportError:
         return {"error": "openai_sdk_missing"}
 
-    client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None)
-
+    extra = {}
+    if expect_json:
+        extra["response_format"] = (
+            {"type": "json_schema", "json_schema": {"name": "tutor_payload", "strict": True, "schema": schema}}
+            if schema else _JSON_MODE
+        )
     for attempt in range(retry_attempts):
         try:
             resp = client.chat.completions.create(
-                model=(os.getenv("LLM_MODEL") or "gpt-4o-mini"),
+                model=LLM_MODEL,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=temperature,
                 max_tokens=max_tokens,
-                stream=False,
+                stream=stream,
+                **extra,
             )
-            content = resp.choices[0].message.content
-            try:
-                return json.loads(content)
-            except json.JSONDecodeError:
-                return {"content": content}
+            if stream:
+                # как и в ветке DeepSeek: длинный ответ приходит кусками и не упирается в таймаут чтения
+                content = "".join(
+                    chunk.choices[0].delta.content
+                    for chunk in resp
+                    if chunk.choices and chunk.choices[0].delta.content
+                )
+            else:
+                content = resp.choices[0].message.content
+            return _parse_llm_content(content, expect_json)
         except Exception as e:
             if attempt == retry_attempts - 1:
                 st.error(f"Ошибка LLM провайдера: {e}")
@@ -198,72 +407,494 @@ def call_llm(prompt: str) -> dict:
             time.sleep(0.5 * (2 ** attempt))
 
 
+def stream_llm_text(prompt: str, max_tokens: int | None = None):
+    """
+    Текстовый ответ по кускам, для вывода по мере генерации (подсказки).
+    Без повторов: при ошибке поток просто заканчивается, и вызывающий берёт запасной текст.
+    """
+    if not DEEPSEEK_ENABLED:
+        return
+    temperature = DEEPSEEK_CONFIG.get("temperature", 0.7)
+    max_tokens = max_tokens or DEEPSEEK_CONFIG.get("max_tokens", 1800)
+    timeout_s = DEEPSEEK_CONFIG.get("timeout", 60)
+    messages = [{"role": "user", "content": prompt}]
+    try:
+        if LLM_PROVIDER == "deepseek":
+            payload = {
+                "model": LLM_MODEL,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "stream": True,
+            }
+            with _deepseek_session().post(
+                "https://api.deepseek.com/v1/chat/completions",
+                data=_json_dumps(payload),
+                timeout=timeout_s,
+                stream=True,
+            ) as resp:
+                resp.raise_for_status()
+                yield from _iter_deepseek_stream(resp)
+        else:
+            for chunk in _openai_client().chat.completions.create(
+                model=LLM_MODEL, messages=messages, temperature=temperature, max_tokens=max_tokens, stream=True
+            ):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    except Exception:
+        return
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Генераторы контента
-def gen_theory_questions(topic: str, subject: str, grade: str, count: int):
-    prompt = f"""
-Сгенерируй {count} тестовых вопрос(ов) по теме "{topic}" для {grade}-го класса по предмету "{subject}".
-Требования:
-- Каждый вопрос проверяет ключевую идею текущей темы.
-- 4 варианта ответа: A), B), C), D).
-- Ровно один правильный вариант.
-- Дай короткое объяснение почему правильный вариант верный.
-- Формулы — только в LaTeX, например: \\(x^2+2x+1=0\\).
-
-Верни строго ВАЛИДНЫЙ JSON без комментариев и многоточий:
-{{
-  "questions": [
-    {{
-      "question": "Текст вопроса с \\( ... \\) где нужно",
-      "options": ["A) ...", "B) ...", "C) ...", "D) ..."],
-      "correct_answer": "A",
-      "explanation": "Краткое объяснение"
-    }}
-  ]
-}}
-"""
-    return call_llm(prompt)
+# Генерация — самая дорогая операция (десятки секунд, платные токены), поэтому
+# результат кэшируется по смысловым аргументам и переиспользуется между сессиями.
+class _UncachedResult(Exception):
+    """Ответ, который нельзя класть в кэш (ошибка или неполный набор)."""
 
+    def __init__(self, data):
+        super().__init__("uncached result")
+        self.data = data
 
-def gen_practice_tasks(topic: str, subject: str, grade: str, perf: float | None):
+
+# Ключ кэша генераций — входы промпта (тема, предмет, класс, объём) плюс _llm_cache_key():
+# промпт из них строится детерминированно, так что хэшировать его текст отдельно не нужно.
+_LLM_CACHE_TTL = DEEPSEEK_CONFIG.get("llm_cache_ttl", 7 * 24 * 3600)
+
+
+def _llm_cache_key() -> tuple:
+    """Модель и температура — часть ключа кэша: после смены настроек старые ответы не отдаются."""
+    return (LLM_PROVIDER, LLM_MODEL, DEEPSEEK_CONFIG.get("temperature", 0.7))
+
+
+# Второй уровень кэша — JSON-файлы на диске: кэш процесса пустеет при перезапуске/деплое,
+# а вопросы к одной и той же теме от этого не меняются. Версию схемы поднимать при
+# изменении формата промптов/ответов — старые файлы перестанут совпадать по ключу.
+_LESSON_STORE_DIR = DEEPSEEK_CONFIG.get("lesson_store_dir")
+_LESSON_STORE_TTL = DEEPSEEK_CONFIG.get("lesson_store_ttl", 30 * 24 * 3600)
+_PROMPT_SCHEMA_VERSION = 1
+
+
+def _store_path(key: tuple) -> str:
+    digest = hashlib.blake2b(_json_dumps([_PROMPT_SCHEMA_VERSION, *key]), digest_size=16).hexdigest()
+    return os.path.join(_LESSON_STORE_DIR, f"{key[0]}-{digest}.json")
+
+
+def _store_get(key: tuple):
+    """Сохранённая генерация или None (нет файла, устарел, битый, хранилище выключено)."""
+    if not _LESSON_STORE_DIR:
+        return None
+    try:
+        with open(_store_path(key), "rb") as f:
+            record = _json_loads(f.read())
+    except (OSError, json.JSONDecodeError):
+        return None
+    # валидный JSON ещё не значит запись: файл мог быть испорчен или записан другой версией
+    if not isinstance(record, dict):
+        return None
+    saved_at = record.get("saved_at")
+    if not isinstance(saved_at, (int, float)) or time.time() - saved_at > _LESSON_STORE_TTL:
+        return None
+    data = record.get("data")
+    return data if isinstance(data, dict) else None
+
+
+def _store_put(key: tuple, data: dict):
+    if not _LESSON_STORE_DIR:
+        return
+    record = {"saved_at": time.time(), "model": LLM_MODEL, "schema": _PROMPT_SCHEMA_VERSION, "data": data}
+    try:
+        os.makedirs(_LESSON_STORE_DIR, exist_ok=True)
+        # пишем во временный файл и подменяем: параллельная генерация не оставит половину JSON
+        fd, tmp = tempfile.mkstemp(dir=_LESSON_STORE_DIR, suffix=".tmp")
+    except OSError:
+        return  # диск — лишь ускорение; без него работает кэш процесса
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_json_dumps(record))
+        os.replace(tmp, _store_path(key))
+    except OSError:
+        # не оставляем в каталоге недописанный временный файл
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+def _perf_bucket(perf: float | None) -> int:
+    """Грубая корзина успеваемости: -1 — слабо, 0 — норма/нет данных, 1 — сильно."""
+    if perf is None:
+        return 0
+    if perf < 60:
+        return -1
+    if perf > 85:
+        return 1
+    return 0
+
+
+# Промпты: оплачиваются и обрабатываются по токенам, поэтому шаблоны ужимаются —
+# JSON-образцы без отступов, строки без ведущих пробелов и пустых строк.
+_WS = re.compile(r"[ \t]+")
+_NL = re.compile(r"\s*\n\s*")
+
+
+def _compact(text: str) -> str:
+    return _NL.sub("\n", _WS.sub(" ", text)).strip()
+
+
+def _compact_json(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+_QUESTION_JSON = _compact_json(
+    {
+        "question": "Текст вопроса с \\( ... \\) где нужно",
+        "options": ["A) ...", "B) ...", "C) ...", "D) ..."],
+        "correct_answer": "A",
+        "explanation": "Краткое объяснение",
+    }
+)
+_TASK_JSON = _compact_json(
+    {
+        "question": "Условие ... с LaTeX",
+        "answer": "Правильный ответ",
+        "solution": "Пошаговое решение с LaTeX",
+        "hint": "Короткая подсказка",
+    }
+)
+_TASK_TYPES = ("easy", "medium", "hard")
+_LEVEL_WORDS = {"easy": "лёгких", "medium": "средних", "hard": "сложных"}
+
+
+def _practice_json(levels) -> str:
+    # образец задачи — только у первого уровня, остальные «[...]»
+    return "{" + ",".join(
+        [f'"{levels[0]}":[{_TASK_JSON}]'] + [f'"{lv}":[...]' for lv in levels[1:]]
+    ) + "}"
+
+
+# Те же формы в виде JSON Schema — для строгого structured output (см. call_llm).
+# Строгий режим требует перечислить все поля в required и запретить лишние.
+def _object_schema(props: dict) -> dict:
+    return {"type": "object", "properties": props, "required": list(props), "additionalProperties": False}
+
+
+_STR = {"type": "string"}
+_QUESTION_SCHEMA = _object_schema({
+    "question": _STR,
+    "options": {"type": "array", "items": _STR},
+    "correct_answer": {"type": "string", "enum": ["A", "B", "C", "D"]},
+    "explanation": _STR,
+})
+_TASK_SCHEMA = _object_schema({"question": _STR, "answer": _STR, "solution": _STR, "hint": _STR})
+_THEORY_SCHEMA = _object_schema({"questions": {"type": "array", "items": _QUESTION_SCHEMA}})
+
+
+def _practice_schema(levels) -> dict:
+    return _object_schema({lv: {"type": "array", "items": _TASK_SCHEMA} for lv in levels})
+
+
+_PRACTICE_SCHEMA = _practice_schema(_TASK_TYPES)
+_LESSON_SCHEMA = _object_schema({
+    "questions": {"type": "array", "items": _QUESTION_SCHEMA},
+    "practice": _PRACTICE_SCHEMA,
+})
+
+
+# Неизменная часть инструкций идёт первой, тема/количество — в конце: DeepSeek кэширует
+# совпадающий префикс запросов, и повторные генерации по другим темам платят за него по
+# сниженной цене и обрабатываются быстрее.
+_THEORY_RULES = _compact(f"""
+    Ты составляешь тестовые вопросы для школьников.
+    Требования:
+    - Каждый вопрос проверяет ключевую идею текущей темы.
+    - 4 варианта ответа: A), B), C), D).
+    - Ровно один правильный вариант.
+    - Дай короткое объяснение почему правильный вариант верный.
+    - Формулы — только в LaTeX, например: \\(x^2+2x+1=0\\).
+    Ответ — JSON такого вида:
+    {{"questions":[{_QUESTION_JSON}]}}
+""")
+
+
+def _theory_prompt(topic: str, subject: str, grade: str, count: int) -> str:
+    return (
+        f"{_THEORY_RULES}\n"
+        f'Сгенерируй {count} тестовых вопрос(ов) по теме "{topic}" для {grade}-го класса по предмету "{subject}".'
+    )
+
+
+def _practice_counts(levels) -> str:
+    per_level = APP_CONFIG["tasks_per_difficulty"]
+    return ", ".join(f"{per_level[lv]} {_LEVEL_WORDS[lv]}" for lv in levels)
+
+
+def _practice_rules(levels) -> str:
+    return _compact(f"""
+        Ты составляешь практические задания для школьников: {_practice_counts(levels)}.
+        Для каждой задачи:
+        - Чёткое условие; формулы — в LaTeX (\\( ... \\)).
+        - Точный правильный ответ (текст/число; без LaTeX, например: "x >= 2, x < 3").
+        - Пошаговое решение (с LaTeX).
+        - Короткую подсказку (без LaTeX, не раскрывающую решение полностью).
+        Ответ — JSON такого вида:
+        {_practice_json(levels)}
+    """)
+
+
+def _practice_prompt(topic: str, subject: str, grade: str, bucket: int, levels=_TASK_TYPES) -> str:
     adjustment = ""
-    if perf is not None:
-        if perf < 60:
-            adjustment = "Сделай упор на базу и подробные объяснения."
-        elif perf > 85:
-            adjustment = "Добавь нестандартные и более сложные задачи."
-
-    e = APP_CONFIG["tasks_per_difficulty"]["easy"]
-    m = APP_CONFIG["tasks_per_difficulty"]["medium"]
-    h = APP_CONFIG["tasks_per_difficulty"]["hard"]
-
-    prompt = f"""
-Составь практические задания по теме "{topic}" для {grade}-го класса по предмету "{subject}":
-- {e} лёгких, {m} средних, {h} сложных.
-
-{adjustment}
-
-Для каждой задачи:
-- Чёткое условие; формулы — в LaTeX (\\( ... \\)).
-- Точный правильный ответ (текст/число; без LaTeX, например: "x >= 2, x < 3").
-- Пошаговое решение (с LaTeX).
-- Короткую подсказку (без LaTeX, не раскрывающую решение полностью).
-
-Верни строго ВАЛИДНЫЙ JSON без многоточий:
-{{
-  "easy": [
-    {{
-      "question": "Условие ... с LaTeX",
-      "answer": "Правильный ответ",
-      "solution": "Пошаговое решение с LaTeX",
-      "hint": "Короткая подсказка"
-    }}
-  ],
-  "medium": [...],
-  "hard": [...]
-}}
-"""
-    return call_llm(prompt)
+    if bucket < 0:
+        adjustment = " Сделай упор на базу и подробные объяснения."
+    elif bucket > 0:
+        adjustment = " Добавь нестандартные и более сложные задачи."
+
+    return (
+        f"{_practice_rules(levels)}\n"
+        f'Составь задания по теме "{topic}" для {grade}-го класса по предмету "{subject}".{adjustment}'
+    )
+
+
+_LESSON_RULES = _compact(f"""
+    Ты готовишь материалы урока для школьников.
+    1) Тестовые вопросы по теории:
+    - Каждый вопрос проверяет ключевую идею текущей темы.
+    - 4 варианта ответа: A), B), C), D). Ровно один правильный вариант.
+    - Короткое объяснение, почему правильный вариант верный.
+    2) Практические задания: {_practice_counts(_TASK_TYPES)}. Для каждой задачи:
+    - Чёткое условие.
+    - Точный правильный ответ (текст/число; без LaTeX, например: "x >= 2, x < 3").
+    - Пошаговое решение.
+    - Короткую подсказку (без LaTeX, не раскрывающую решение полностью).
+    Формулы в вопросах, условиях и решениях — только в LaTeX, например: \\(x^2+2x+1=0\\).
+    Ответ — JSON такого вида:
+    {{"questions":[{_QUESTION_JSON}],"practice":{_practice_json(_TASK_TYPES)}}}
+""")
+
+
+def _lesson_prompt(topic: str, subject: str, grade: str, count: int) -> str:
+    return (
+        f"{_LESSON_RULES}\n"
+        f'Тема урока: "{topic}", {grade}-й класс, предмет "{subject}". Тестовых вопросов: {count}.'
+    )
+
+
+def _has_questions(data, count: int) -> bool:
+    return isinstance(data, dict) and not data.get("error") and len(data.get("questions") or []) >= count
+
+
+def _has_tasks(data) -> bool:
+    return isinstance(data, dict) and not data.get("error") and any(data.get(t) for t in _TASK_TYPES)
+
+
+# Ошибки, после которых повторять запрос бессмысленно.
+_FATAL_LLM_ERRORS = ("402", "openai_sdk_missing", "llm_disabled")
+
+
+@st.cache_resource(show_spinner=False)
+def _llm_fanout_pool() -> ThreadPoolExecutor:
+    # отдельный пул: задачи из _generation_pool ждут свои дозапросы и не должны занимать их потоки
+    return ThreadPoolExecutor(max_workers=DEEPSEEK_CONFIG.get("max_parallel", 3), thread_name_prefix="llm-fanout")
+
+
+def _call_llm_many(calls: list[tuple[str, int, dict]]) -> list[dict]:
+    """Независимые запросы (prompt, max_tokens, schema) параллельно; ответы — в том же порядке."""
+    if len(calls) == 1:
+        prompt, max_tokens, schema = calls[0]
+        return [call_llm(prompt, stream=True, max_tokens=max_tokens, schema=schema)]
+    pool = _llm_fanout_pool()
+    futures = [
+        pool.submit(call_llm, prompt, stream=True, max_tokens=max_tokens, schema=schema)
+        for prompt, max_tokens, schema in calls
+    ]
+    return [f.result() for f in futures]
+
+
+def _topup_questions(data, topic: str, subject: str, grade: str, count: int):
+    """
+    Основной набор просим одним запросом; если модель прислала меньше, дозапрашиваем
+    только недостающие вопросы (не больше theory_topup_retries раз). Недобор делится
+    на пачки до 5 вопросов, которые уходят параллельно.
+    """
+    if not isinstance(data, dict) or data.get("error"):
+        return data
+    qs = [q for q in (data.get("questions") or []) if isinstance(q, dict)]
+    full_tokens = DEEPSEEK_CONFIG.get("max_tokens_theory", 3400)
+    for _ in range(DEEPSEEK_CONFIG.get("theory_topup_retries", 0)):
+        short = count - len(qs)
+        if short <= 0:
+            break
+        sizes = [min(5, short - i) for i in range(0, short, 5)]
+        calls = [
+            (_theory_prompt(topic, subject, grade, n), max(600, full_tokens * n // count), _THEORY_SCHEMA)
+            for n in sizes
+        ]
+        for extra in _call_llm_many(calls):
+            if isinstance(extra, dict) and not extra.get("error"):
+                qs.extend(q for q in (extra.get("questions") or []) if isinstance(q, dict))
+    data["questions"] = qs[:count]
+    return data
+
+
+# _refresh не входит в ключ кэша (Streamlit не хэширует параметры с "_"): только велит не брать файл с диска
+@st.cache_data(ttl=_LLM_CACHE_TTL, max_entries=256, show_spinner=False)
+def _cached_theory_questions(topic: str, subject: str, grade: str, count: int, llm: tuple, _refresh=False) -> dict:
+    store_key = ("theory", subject, grade, topic, count, *llm)
+    if not _refresh and (stored := _store_get(store_key)) is not None:
+        return stored
+    data = call_llm(
+        _theory_prompt(topic, subject, grade, count),
+        stream=True,
+        max_tokens=DEEPSEEK_CONFIG.get("max_tokens_theory"),
+        schema=_THEORY_SCHEMA,
+    )
+    data = _topup_questions(data, topic, subject, grade, count)
+    # ошибки и недобор вопросов не кэшируем — иначе «Попробовать снова» вернёт то же самое
+    if not _has_questions(data, count):
+        raise _UncachedResult(data)
+    _store_put(store_key, data)
+    return data
+
+
+def _fill_practice_levels(data, topic: str, subject: str, grade: str, bucket: int):
+    """Если общий запрос практики упал или пропустил уровни — дозапрашиваем их параллельно, по уровню на запрос."""
+    if isinstance(data, dict) and data.get("error") in _FATAL_LLM_ERRORS:
+        return data
+    tasks = data if isinstance(data, dict) and not data.get("error") else {}
+    missing = [lv for lv in _TASK_TYPES if not tasks.get(lv)]
+    if not missing:
+        return data
+    full_tokens = DEEPSEEK_CONFIG.get("max_tokens_practice", 2800)
+    calls = [
+        (_practice_prompt(topic, subject, grade, bucket, (lv,)), max(800, full_tokens // 2), _practice_schema((lv,)))
+        for lv in missing
+    ]
+    for lv, extra in zip(missing, _call_llm_many(calls)):
+        if isinstance(extra, dict) and not extra.get("error") and extra.get(lv):
+            tasks[lv] = extra[lv]
+    return tasks if _has_tasks(tasks) else data
+
+
+@st.cache_data(ttl=_LLM_CACHE_TTL, max_entries=256, show_spinner=False)
+def _cached_practice_tasks(topic: str, subject: str, grade: str, bucket: int, llm: tuple) -> dict:
+    store_key = ("practice", subject, grade, topic, bucket, *llm)
+    if (stored := _store_get(store_key)) is not None:
+        return stored
+    data = call_llm(
+        _practice_prompt(topic, subject, grade, bucket),
+        stream=True,
+        max_tokens=DEEPSEEK_CONFIG.get("max_tokens_practice"),
+        schema=_PRACTICE_SCHEMA,
+    )
+    data = _fill_practice_levels(data, topic, subject, grade, bucket)
+    if not _has_tasks(data):
+        raise _UncachedResult(data)
+    _store_put(store_key, data)
+    return data
+
+
+@st.cache_data(ttl=_LLM_CACHE_TTL, max_entries=256, show_spinner=False)
+def _cached_full_lesson(topic: str, subject: str, grade: str, count: int, llm: tuple, _refresh=False) -> dict:
+    store_key = ("lesson", subject, grade, topic, count, *llm)
+    if not _refresh and (stored := _store_get(store_key)) is not None:
+        return stored
+    data = call_llm(
+        _lesson_prompt(topic, subject, grade, count),
+        stream=True,
+        max_tokens=DEEPSEEK_CONFIG.get("max_tokens_lesson"),
+        schema=_LESSON_SCHEMA,
+    )
+    data = _topup_questions(data, topic, subject, grade, count)
+    if not (_has_questions(data, count) and _has_tasks(data.get("practice"))):
+        raise _UncachedResult(data)
+    _store_put(store_key, data)
+    return data
+
+
+def gen_theory_questions(topic: str, subject: str, grade: str, count: int, force_refresh: bool = False):
+    if not DEEPSEEK_ENABLED:
+        return {"error": "llm_disabled"}
+    if force_refresh:
+        _cached_theory_questions.clear(topic, subject, grade, count, _llm_cache_key())
+    try:
+        return _cached_theory_questions(topic, subject, grade, count, _llm_cache_key(), _refresh=force_refresh)
+    except _UncachedResult as e:
+        return e.data
+
+
+def gen_practice_tasks(topic: str, subject: str, grade: str, perf: float | None):
+    if not DEEPSEEK_ENABLED:
+        return {"error": "llm_disabled"}
+    try:
+        return _cached_practice_tasks(topic, subject, grade, _perf_bucket(perf), _llm_cache_key())
+    except _UncachedResult as e:
+        return e.data
+
+
+def gen_full_lesson(topic: str, subject: str, grade: str, count: int, force_refresh: bool = False):
+    """
+    Теория и практика одним запросом: {"questions": [...], "practice": {"easy": [...], ...}}.
+    Практика генерируется без учёта балла теории, поэтому годится только для средней корзины;
+    для слабого/сильного результата show_practice_stage строит отдельный набор.
+    """
+    if not DEEPSEEK_ENABLED:
+        return {"error": "llm_disabled"}
+    if force_refresh:
+        _cached_full_lesson.clear(topic, subject, grade, count, _llm_cache_key())
+    try:
+        return _cached_full_lesson(topic, subject, grade, count, _llm_cache_key(), _refresh=force_refresh)
+    except _UncachedResult as e:
+        return e.data
+
+
+def gen_theory_stage(topic: str, subject: str, grade: str, count: int, force_refresh: bool = False):
+    """
+    Генерация для этапа теории: весь урок разом или только вопросы (см. APP_CONFIG).
+    force_refresh выбрасывает закэшированный ответ — для кнопки «Попробовать снова».
+    """
+    if APP_CONFIG.get("bundle_lesson_generation"):
+        return gen_full_lesson(topic, subject, grade, count, force_refresh)
+    return gen_theory_questions(topic, subject, grade, count, force_refresh)
+
+
+# Фоновая генерация: запрос к LLM стартует заранее (например, практика — сразу после
+# подсчёта баллов теории), а страница потом просто забирает готовый Future.
+@st.cache_resource(show_spinner=False)
+def _generation_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm-gen")
+
+
+def _submit_generation(key: str, fn, *args):
+    """Запускает fn(*args) в фоне один раз на ключ; Future хранится в session_state."""
+    if not DEEPSEEK_ENABLED:
+        return  # генерировать нечем — не занимаем поток и не заводим Future
+    pending = st.session_state.setdefault("pending_gen", {})
+    if key not in pending:
+        pending[key] = _generation_pool().submit(fn, *args)
+
+
+def _take_generation(key: str):
+    """
+    Готовый результат фоновой генерации или None — тогда вызывающий идёт в синхронный
+    gen_*. Долго ждать Future нельзя: пул общий на процесс, и задача может ещё стоять в
+    очереди за чужими упреждающими генерациями. Не начатую задачу снимаем с очереди, а
+    уже идущую не ждём: синхронный вызов попадёт в тот же ключ st.cache_data и дождётся
+    её под блокировкой кэша, не запуская вторую генерацию.
+    """
+    fut = st.session_state.get("pending_gen", {}).pop(key, None)
+    if fut is None or fut.cancel():
+        return None
+    try:
+        return fut.result(timeout=0.1)
+    except Exception:
+        return None
+
+
+def _cancel_generation(key: str):
+    """Снимает фоновую генерацию с очереди (если ещё не началась) и забывает её Future."""
+    fut = st.session_state.get("pending_gen", {}).pop(key, None)
+    if fut is not None:
+        fut.cancel()
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -285,24 +916,148 @@ def coerce_questions_to_count(qs: list[dict], need: int) -> list[dict]:
     return qs[:need]
 
 
+_LETTERS = ("A", "B", "C", "D")
+_LETTERS_SET = frozenset(_LETTERS)
+_LETTER_PREFIXES = ("A)", "B)", "C)", "D)")
+
+
 def sanitize_mc_options(options: list) -> list[str]:
     """Гарантируем 4 строки формата 'X) ...'."""
-    base = ["A) —", "B) —", "C) —", "D) —"]
     if not isinstance(options, list) or len(options) != 4:
-        return base
+        return ["A) —", "B) —", "C) —", "D) —"]
     fixed = []
-    letters = ["A", "B", "C", "D"]
     for i, opt in enumerate(options):
         text = str(opt).strip()
         # если модель не проставила "A) ", добавим
-        if not text.startswith(f"{letters[i]})"):
-            text = f"{letters[i]}) {text}"
+        if text[:2] != _LETTER_PREFIXES[i]:
+            text = f"{_LETTERS[i]}) {text}"
         fixed.append(text)
     return fixed
 
 
+def normalize_theory_questions(raw_qs, need: int) -> list[dict]:
+    """
+    Не больше need вопросов в едином виде. Битые элементы пропускаются явными проверками
+    (их место займут заглушки coerce_questions_to_count), без try/except на каждый вопрос.
+    """
+    qs = []
+    if not isinstance(raw_qs, list):
+        return qs
+    for q in raw_qs:
+        if len(qs) >= need:
+            break
+        if not isinstance(q, dict):
+            continue
+        question = q.get("question")
+        if not isinstance(question, str) or not question.strip():
+            continue
+        options = q.get("options")
+        if not isinstance(options, list) or len(options) != 4:
+            continue
+        if not all(isinstance(o, (str, int, float)) for o in options):
+            continue
+        ca = q.get("correct_answer")
+        ca = ca.strip()[:1].upper() if isinstance(ca, str) else ""
+        explanation = q.get("explanation")
+        qs.append(
+            {
+                "question": question.strip(),
+                "options": sanitize_mc_options(options),
+                "correct_answer": ca if ca in _LETTERS_SET else "A",
+                "explanation": explanation.strip() if isinstance(explanation, str) else "",
+            }
+        )
+    return qs
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # YouTube + Tutor
+# Плейлисты меняются редко — кэшируем сам HTTP-запрос; ошибки (исключения) не кэшируются,
+# а st.error/логирование остаются снаружи, в EnhancedAITutor.get_playlist_videos.
+# Префиксы ID плейлистов YouTube: обычные, загрузки канала, понравившиеся, избранное.
+_PLAYLIST_PREFIXES = ("PL", "UU", "LL", "FL")
+# PLAYLISTS известен при импорте — проверяем ID один раз, дальше это просто поиск в множестве
+_VALID_PLAYLIST_IDS = frozenset(
+    pid
+    for grades in PLAYLISTS.values()
+    for pid in grades.values()
+    if isinstance(pid, str) and pid.startswith(_PLAYLIST_PREFIXES)
+)
+
+
+@st.cache_resource(show_spinner=False)
+def _playlist_etags() -> dict:
+    """(playlist_id, page_token) -> (ETag, страница): переживает истечение TTL кэша ниже, для условных GET."""
+    return {}
+
+
+_PLAYLIST_FIELDS = (
+    "etag,nextPageToken,"
+    "items/snippet(title,description,publishedAt,resourceId/videoId,"
+    "thumbnails/high/url,thumbnails/medium/url,thumbnails/default/url)"
+)
+
+
+def _pick_thumb(thumbs) -> str:
+    """URL самой крупной из запрошенных превью (см. _PLAYLIST_FIELDS) или пустая строка."""
+    if thumbs:
+        for size in ("high", "medium", "default"):
+            url = (thumbs.get(size) or {}).get("url")
+            if url:
+                return url
+    return ""
+
+
+# Параметры с "_" Streamlit не хэширует: ключ API не попадает в ключ кэша.
+# Плейлист читается постранично: следующая страница запрашивается, только когда ученик до неё дошёл.
+@st.cache_data(ttl=APP_CONFIG.get("playlist_cache_ttl", 6 * 3600), max_entries=64, show_spinner=False)
+def _fetch_playlist_videos(playlist_id: str, max_results: int, _api_key: str, page_token: str = "") -> dict:
+    """{"videos": [...], "next_page_token": str | None} — одна страница playlistItems."""
+    url = "https://www.googleapis.com/youtube/v3/playlistItems"
+    params = {
+        # только snippet и только читаемые ниже поля: ответ в разы короче
+        "part": "snippet",
+        "fields": _PLAYLIST_FIELDS,
+        "playlistId": playlist_id,
+        "maxResults": max_results,
+        "key": _api_key,
+    }
+    if page_token:
+        params["pageToken"] = page_token
+    etags = _playlist_etags()
+    known = etags.get((playlist_id, page_token))
+    # после истечения TTL сначала спрашиваем «изменилось ли?» — 304 приходит без тела
+    headers = {"If-None-Match": known[0]} if known else None
+    r = _youtube_session().get(url, params=params, headers=headers, timeout=10)
+    if r.status_code == 304 and known:
+        return known[1]
+    r.raise_for_status()
+    data = _json_loads(r.content)
+    videos = []
+    append = videos.append
+    for item in data.get("items", []):
+        sn = item.get("snippet") or {}
+        vid = (sn.get("resourceId") or {}).get("videoId")
+        # видео без id (удалённые/приватные) отбрасываем до разбора остальных полей
+        if not vid:
+            continue
+        desc = sn.get("description") or ""
+        append(
+            {
+                "title": sn.get("title", "Без названия"),
+                "video_id": vid,
+                "description": desc[:200] + "..." if len(desc) > 200 else desc,
+                "thumbnail": _pick_thumb(sn.get("thumbnails")),
+                "published_at": sn.get("publishedAt", ""),
+            }
+        )
+    page = {"videos": videos, "next_page_token": data.get("nextPageToken")}
+    etag = r.headers.get("ETag") or data.get("etag")
+    if etag:
+        etags[(playlist_id, page_token)] = (etag, page)
+    return page
+
+
 class EnhancedAITutor:
     def __init__(self):
         self.youtube_api_key = YOUTUBE_API_KEY
@@ -310,74 +1065,111 @@ class EnhancedAITutor:
         self.config = APP_CONFIG
         self.ui_config = UI_CONFIG
 
-    def get_playlist_videos(self, playlist_id: str) -> list[dict]:
-        if not (isinstance(playlist_id, str) and playlist_id.startswith("PL")):
-            st.error(f"Неверный формат ID плейлиста: {playlist_id}. Ожидается начало 'PL'.")
+    def get_playlist_videos(self, playlist_id: str, page_token: str = "") -> tuple[list[dict], str | None]:
+        """Одна страница плейлиста и токен следующей (None — страниц больше нет или ошибка)."""
+        if playlist_id not in _VALID_PLAYLIST_IDS:
+            st.error(
+                f"Неверный ID плейлиста: {playlist_id}. "
+                f"Ожидается ID из config.PLAYLISTS с началом {', '.join(_PLAYLIST_PREFIXES)}."
+            )
             log_user_action("invalid_playlist_id", {"playlist_id": playlist_id})
-            return []
-
-        url = "https://www.googleapis.com/youtube/v3/playlistItems"
-        params = {
-            "part": "snippet,contentDetails",
-            "playlistId": playlist_id,
-            "maxResults": self.config["youtube_max_results"],
-            "key": self.youtube_api_key,
-        }
+            return [], None
+
         try:
-            r = requests.get(url, params=params, timeout=10)
-            r.raise_for_status()
-            data = r.json()
-            videos = []
-            for item in data.get("items", []):
-                sn = item.get("snippet", {}) or {}
-                rid = sn.get("resourceId", {}) or {}
-                thumbs = sn.get("thumbnails", {}) or {}
-                thumb = thumbs.get("high") or thumbs.get("medium") or thumbs.get("default") or {}
-                vid = rid.get("videoId")
-                if not vid:
-                    continue
-                videos.append(
-                    {
-                        "title": sn.get("title", "Без названия"),
-                        "video_id": vid,
-                        "description": (sn.get("description") or "")[:200]
-                        + ("..." if len(sn.get("description") or "") > 200 else ""),
-                        "thumbnail": thumb.get("url", ""),
-                        "published_at": sn.get("publishedAt", ""),
-                    }
-                )
-            log_user_action("playlist_loaded", {"count": len(videos), "playlist_id": playlist_id})
-            return videos
+            # page_token — всегда именованным: ключ кэша строится по переданным аргументам,
+            # и вызов с ним и без него (как в _warm_playlists) попал бы в разные записи
+            page = _fetch_playlist_videos(
+                playlist_id, self.config["youtube_max_results"], self.youtube_api_key, page_token=page_token
+            )
+            log_user_action("playlist_loaded", {"count": len(page["videos"]), "playlist_id": playlist_id})
+            return page["videos"], page["next_page_token"]
         except requests.exceptions.Timeout:
             st.error("Превышено время ожидания ответа от YouTube API")
             log_user_action("playlist_error", {"error": "timeout", "playlist_id": playlist_id})
-            return []
+            return [], None
         except requests.exceptions.HTTPError as e:
             st.error(f"Ошибка HTTP при загрузке плейлиста: {e.response.status_code}")
             log_user_action("playlist_error", {"error": str(e), "playlist_id": playlist_id})
-            return []
+            return [], None
         except Exception as e:
             st.error(f"Ошибка при загрузке видео: {str(e)}")
             log_user_action("playlist_error", {"error": str(e), "playlist_id": playlist_id})
-            return []
+            return [], None
+
+    def load_more_videos(self, session: SessionManager) -> bool:
+        """Догружает следующую страницу курса, когда ученик дошёл до конца загруженной."""
+        token = session.get_next_page_token()
+        playlist_id = session.get_playlist_id()
+        if not (token and playlist_id):
+            return False
+        videos, next_token = self.get_playlist_videos(playlist_id, token)
+        if not videos:
+            return False
+        session.extend_videos(videos, next_token)
+        return True
+
+    def warm_playlists(self):
+        # некорректные ID уже отсеяны в _VALID_PLAYLIST_IDS — их ошибку покажет get_playlist_videos при выборе
+        ids = tuple(sorted(_VALID_PLAYLIST_IDS))
+        _warm_playlists(ids, self.config["youtube_max_results"], self.youtube_api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_playlists(playlist_ids: tuple, max_results: int, _api_key: str) -> bool:
+    """
+    Один раз на процесс параллельно прогревает кэш _fetch_playlist_videos для всех плейлистов,
+    не дожидаясь ответа: «Начать обучение» потом берёт список из кэша без сетевого запроса.
+    """
+    pool = ThreadPoolExecutor(max_workers=min(8, len(playlist_ids) or 1), thread_name_prefix="yt-warm")
+    for pid in playlist_ids:
+        pool.submit(_fetch_playlist_videos, pid, max_results, _api_key, page_token="")
+    # потоки доработают сами; ошибки не кэшируются и повторятся уже при клике
+    pool.shutdown(wait=False)
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def get_tutor() -> EnhancedAITutor:
+    """Тьютор не хранит состояния сессии — один экземпляр на процесс."""
+    return EnhancedAITutor()
+
+
+def get_session_manager() -> SessionManager:
+    """
+    SessionManager — один на сессию браузера. В cache_resource его класть нельзя: экземпляр
+    стал бы общим для всех пользователей, а __init__ заводит состояние каждой новой сессии.
+    """
+    mgr = st.session_state.get("_session_manager")
+    if mgr is None:
+        mgr = st.session_state["_session_manager"] = SessionManager()
+    return mgr
 
 
 # ──────────────────────────────────────────────────────────────────────────────
 # UI / страницы
+# Списки и подписи для сайдбара/бейджей зависят только от конфига — считаем их при импорте
+_SUBJECTS = tuple(PLAYLISTS)
+_SUBJECT_LABELS = {s: f"{get_subject_emoji(s)} {s}" for s in PLAYLISTS}
+_GRADES = {s: tuple(grades) for s, grades in PLAYLISTS.items()}
+_TASK_TYPE_NAMES = UI_CONFIG["task_type_names"]
+
+
 def main():
+    _inject_static_assets()
     st.markdown('<div class="main-header"><h1>📚 AI Тьютор — персональное обучение</h1></div>', unsafe_allow_html=True)
 
-    tutor = EnhancedAITutor()
-    session = SessionManager()  # если используешь Supabase — оставь как было у тебя
+    tutor = get_tutor()
+    if APP_CONFIG.get("warm_playlists"):
+        tutor.warm_playlists()
+    session = get_session_manager()  # если используешь Supabase — оставь как было у тебя
 
     # Sidebar — выбор курса
     with st.sidebar:
         st.header("📖 Выбор курса")
-        subjects = list(tutor.playlists.keys())
-        selected_subject = st.selectbox("Предмет:", subjects, format_func=lambda x: f"{get_subject_emoji(x)} {x}")
+        selected_subject = st.selectbox("Предмет:", _SUBJECTS, format_func=_SUBJECT_LABELS.__getitem__)
 
         if selected_subject:
-            grades = list(tutor.playlists[selected_subject].keys())
+            grades = _GRADES[selected_subject]
             selected_grade = st.selectbox("Класс:", grades)
 
             if selected_grade:
@@ -386,10 +1178,13 @@ def main():
 
                 if st.button("Начать обучение", type="primary"):
                     with st.spinner("Загрузка видео из плейлиста..."):
-                        videos = tutor.get_playlist_videos(playlist_id)
+                        videos, next_token = tutor.get_playlist_videos(playlist_id)
                         if videos:
-                            session.start_course(videos)
-                            st.success(f"Загружено {len(videos)} видео")
+                            resumed = session.start_course(videos, next_token, playlist_id)
+                            # все уроки первой страницы пройдены — продолжаем со следующих страниц
+                            while not resumed and tutor.load_more_videos(session):
+                                resumed = session.resume_course()
+                            st.success(f"Загружено {len(session.get_videos())} видео")
                             st.rerun()
                         else:
                             st.error("Не удалось загрузить видео из плейлиста")
@@ -399,9 +1194,23 @@ def main():
         progress_data = session.get_progress()
         st.metric("Пройдено тем", len(progress_data["completed_topics"]))
 
-        chart = create_progress_chart_data(progress_data)
-        if chart:
-            st.plotly_chart(chart, use_container_width=True)
+        # график строится заново только после изменения прогресса, а не на каждом rerun
+        version = session.get_progress_version()
+        memo = st.session_state.get("_progress_chart")
+        if memo is None or memo[0] != version:
+            memo = st.session_state["_progress_chart"] = (version, create_progress_chart_data(progress_data))
+        chart_df = memo[1]
+        if chart_df is not None:
+            # встроенный Vega-Lite график: без Plotly-фигуры и её валидации на каждом rerun
+            st.caption("Прогресс по темам")
+            st.bar_chart(
+                chart_df,
+                x="Тема",
+                y=["Теория (%)", "Практика (%)"],
+                y_label="Результат (%)",
+                stack=False,
+                height=300,
+            )
 
     # Роутинг
     stage = session.get_stage()
@@ -415,13 +1224,37 @@ def main():
         st.info("👆 Выберите предмет и класс в боковой панели, затем нажмите «Начать обучение».")
 
 
+# Фрагменты этапов: клики внутри перезапускают только свой этап; смена этапа — полным st.rerun()
+@st.fragment
 def display_video_content(session: SessionManager):
     videos = session.get_videos()
     if not videos:
         st.warning("Видео из плейлиста не загружены. Попробуйте перезагрузить страницу.")
         return
 
-    current_video = videos[session.get_current_video_index()]
+    index = session.get_current_video_index()
+    total_videos = len(videos)
+    current_video = videos[index]
+
+    # пока ученик смотрит урок, заранее генерируем тест к нему и вопросы к следующему уроку
+    # (результат ложится и в общий кэш); _submit_generation не дублирует уже запущенное
+    prefetch = []
+    if APP_CONFIG.get("prefetch_current_test"):
+        prefetch.append(current_video["title"])
+    if APP_CONFIG.get("prefetch_next_lesson") and index + 1 < total_videos:
+        prefetch.append(videos[index + 1]["title"])
+    subject, grade = session.get_subject(), session.get_grade()
+    wanted = {f"theory:{subject}_{grade}_{title}": title for title in prefetch}
+    # уроки, пролистанные «Следующим уроком», своих Future уже не заберут — снимаем их,
+    # чтобы упреждающие генерации не занимали общий пул
+    for key in [k for k in st.session_state.get("pending_gen", {}) if k.startswith("theory:")]:
+        if key not in wanted:
+            _cancel_generation(key)
+    if wanted:
+        need_q = int(APP_CONFIG.get("theory_questions_count", 10))
+        for key, title in wanted.items():
+            _submit_generation(key, gen_theory_stage, title, subject, grade, need_q)
+
     col1, col2 = st.columns([2, 1])
 
     with col1:
@@ -432,33 +1265,38 @@ def display_video_content(session: SessionManager):
                 st.write(current_video["description"])
 
     with col2:
-        st.markdown('<div class="progress-card">', unsafe_allow_html=True)
-        st.markdown("### 🎯 Текущий урок")
-        st.info(f"Урок {session.get_current_video_index() + 1} из {len(videos)}")
-        st.progress((session.get_current_video_index() + 1) / len(videos))
-
-        col_a, col_b = st.columns(2)
-        with col_a:
-            if st.button("Готов к тесту", type="primary"):
-                session.set_stage("theory_test")
-                log_user_action("start_theory_test", {"video": current_video["title"]})
-                st.rerun()
-        with col_b:
-            if st.button("Пересмотреть"):
-                log_user_action("rewatch_video", {"video": current_video["title"]})
-                st.rerun()
-
-        if session.get_current_video_index() > 0:
-            if st.button("← Предыдущий урок"):
-                session.prev_video()
-                st.rerun()
-        if session.get_current_video_index() < len(videos) - 1:
-            if st.button("Следующий урок →"):
-                session.next_video()
-                st.rerun()
-        st.markdown("</div>", unsafe_allow_html=True)
-
+        with st.container(border=True):
+            st.markdown("### 🎯 Текущий урок")
+            # в плейлисте есть ещё не загруженные страницы — общее число уроков пока неизвестно
+            has_more = bool(session.get_next_page_token())
+            st.info(f"Урок {index + 1} из {total_videos}{'+' if has_more else ''}")
+            st.progress((index + 1) / total_videos)
 
+            col_a, col_b = st.columns(2)
+            with col_a:
+                if st.button("Готов к тесту", type="primary"):
+                    session.set_stage("theory_test")
+                    log_user_action("start_theory_test", {"video": current_video["title"]})
+                    st.rerun()
+            with col_b:
+                if st.button("Пересмотреть"):
+                    # клик сам перезапускает фрагмент — отдельный st.rerun() не нужен
+                    log_user_action("rewatch_video", {"video": current_video["title"]})
+
+            if index > 0:
+                if st.button("← Предыдущий урок"):
+                    session.prev_video()
+                    st.rerun()
+            if index < total_videos - 1 or has_more:
+                if st.button("Следующий урок →"):
+                    # на последнем загруженном уроке сначала догружаем следующую страницу плейлиста
+                    if session.next_video() or (get_tutor().load_more_videos(session) and session.next_video()):
+                        st.rerun()
+                    else:
+                        st.warning("Не удалось загрузить следующие уроки. Попробуйте позже.")
+
+
+@st.fragment
 def show_theory_test(session: SessionManager):
     videos = session.get_videos()
     if not videos:
@@ -477,113 +1315,139 @@ def show_theory_test(session: SessionManager):
     need_q = int(APP_CONFIG.get("theory_questions_count", 10))
 
     def _retry():
-        if "theory_questions" in st.session_state:
-            del st.session_state["theory_questions"]
-        if "theory_answers" in st.session_state:
-            del st.session_state["theory_answers"]
-        st.rerun()
-
-    if "theory_questions" not in st.session_state:
+        session.clear_theory_data()
+        # набор мог попасть в кэш, но не пройти нормализацию — повтор должен идти мимо кэша
+        st.session_state["theory_refresh"] = True
+
+    # вопросы и ответы живут под одним ключом — одна проверка наличия вместо двух
+    ss = st.session_state
+    theory = ss.setdefault("theory", {"questions": None, "answers": {}})
+    if theory["questions"] is None:
         with st.spinner("Генерация вопросов..."):
-            data = gen_theory_questions(topic, subject, grade, need_q)
+            if ss.pop("theory_refresh", False):
+                # фоновый результат взят из того же кэша — не ждём его
+                _cancel_generation(f"theory:{topic_key}")
+                data = gen_theory_stage(topic, subject, grade, need_q, force_refresh=True)
+            else:
+                data = _take_generation(f"theory:{topic_key}")
+                if not isinstance(data, dict) or data.get("error"):
+                    data = gen_theory_stage(topic, subject, grade, need_q)
+            if isinstance(data, dict) and _has_tasks(data.get("practice")):
+                # практика из общего запроса — пригодится, если балл теории попадёт в среднюю корзину
+                ss.setdefault("lesson_practice", {})[topic_key] = data["practice"]
             # поддержка ошибок
             if isinstance(data, dict) and data.get("error"):
                 st.error("Не удалось сгенерировать вопросы. Попробуйте снова.")
                 st.button("🔁 Попробовать снова", key="retry_top", on_click=_retry)
                 # создаём пустые заглушки, чтобы UI не падал
-                qs = coerce_questions_to_count([], need_q)
-                st.session_state.theory_questions = qs
-                st.session_state.theory_answers = {}
+                theory["questions"] = coerce_questions_to_count([], need_q)
+                theory["answers"] = {}
             else:
-                raw_qs = (data or {}).get("questions", [])
-                # нормализуем опции
-                for q in raw_qs:
-                    q["options"] = sanitize_mc_options(q.get("options", []))
-                    q["question"] = str(q.get("question", "")).strip() or "Вопрос"
-                    q["correct_answer"] = (str(q.get("correct_answer", "A")).strip() or "A")[:1].upper()
-                    q["explanation"] = str(q.get("explanation", "")).strip()
-                qs = coerce_questions_to_count(raw_qs, need_q)
-                st.session_state.theory_questions = qs
-                st.session_state.theory_answers = {}
+                qs = normalize_theory_questions((data or {}).get("questions"), need_q)
+                theory["questions"] = coerce_questions_to_count(qs, need_q)
+                theory["answers"] = {}
 
     # Если модель прислала меньше и мы дозаполнили — предупредим и дадим retry
-    have_real = sum(1 for q in st.session_state.theory_questions if "—" not in "".join(q.get("options", [])))
+    qs = theory["questions"]
+    have_real = sum(1 for q in qs if "—" not in "".join(q.get("options", [])))
     if have_real < need_q:
         st.warning("Модель прислала меньше вопросов, чем нужно. Нажмите «Попробовать снова».")
-        st.button("🔁 Попробовать снова", key="retry_bottom", on_click=lambda: _retry())
-
-    # Рендер вопросов
-    for i, q in enumerate(st.session_state.theory_questions):
-        st.markdown('<div class="task-card">', unsafe_allow_html=True)
-        st.markdown(f"**Вопрос {i+1}:** {q.get('question','')}", unsafe_allow_html=True)
-        answer_key = f"theory_q_{i}"
-        selected = st.radio(
-            "Выберите ответ:",
-            q.get("options", []),
-            key=answer_key,
-            index=None,
-        )
-        if selected:
-            st.session_state.theory_answers[i] = selected[0]  # первая буква (A/B/C/D)
-        st.markdown("</div>", unsafe_allow_html=True)
+        st.button("🔁 Попробовать снова", key="retry_bottom", on_click=_retry)
+
+    # весь тест — одна форма: выбор варианта не перезапускает скрипт,
+    # вопрос выводится подписью радиокнопки, без отдельного markdown и контейнера
+    with st.form("theory_form"):
+        for i, q in enumerate(qs):
+            options = q.get("options", [])
+            # виджет хранит только букву, текст варианта — лишь подпись
+            st.radio(
+                f"**Вопрос {i+1}:** {q.get('question','')}",
+                _LETTERS,
+                format_func=lambda k, options=options: options[ord(k) - 65],
+                key=f"theory_q_{i}",
+                index=None,
+            )
+        submitted = st.form_submit_button("Проверить ответы", type="primary")
 
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("← Вернуться к видео"):
-            session.clear_theory_data()
-            session.set_stage("video")
-            st.rerun()
-    with col2:
-        if st.button("Проверить ответы", type="primary"):
-            if len(st.session_state.theory_answers) != len(st.session_state.theory_questions):
-                st.error("Пожалуйста, ответьте на все вопросы.")
-            else:
-                show_theory_results(session, topic_key)
+    if st.button("← Вернуться к видео"):
+        session.clear_theory_data()
+        session.set_stage("video")
+        st.rerun()
 
+    if submitted:
+        theory["answers"] = {
+            i: a for i in range(len(qs)) if (a := ss.get(f"theory_q_{i}")) is not None
+        }
+        if len(theory["answers"]) == len(qs):
+            grade_theory(session, topic_key, topic)
+        else:
+            theory.pop("verdicts", None)
+            st.error("Пожалуйста, ответьте на все вопросы.")
+    # результаты выводятся по состоянию, а не только в прогоне с нажатой кнопкой —
+    # иначе кнопки под ними исчезают при следующем перезапуске, и клик по ним теряется
+    if "verdicts" in theory:
+        show_theory_results(session)
+
+
+def grade_theory(session: SessionManager, topic_key: str, topic: str):
+    """Подсчёт и сохранение результата — один раз на отправку формы; рендер берёт готовое."""
+    theory = st.session_state.theory
+    answers = theory["answers"]
+    # ответы теории — одна буква A–D с обеих сторон (нормализованы при генерации и выборе),
+    # поэтому общий compare_answers с регулярками здесь не нужен
+    verdicts = theory["verdicts"] = [
+        answers.get(i) == q.get("correct_answer", "A") for i, q in enumerate(theory["questions"])
+    ]
+    score = theory["score"] = calculate_score(sum(verdicts), len(verdicts))
+    session.save_theory_score(topic_key, score)
 
-def show_theory_results(session: SessionManager, topic_key: str):
-    qs = st.session_state.theory_questions
-    answers = st.session_state.theory_answers
+    # практика зависит только от балла теории — начинаем генерировать её, пока ученик читает разбор
+    bucket = _perf_bucket(score)
+    if not (bucket == 0 and topic_key in st.session_state.get("lesson_practice", {})):
+        _submit_generation(
+            f"practice:{topic_key}:{bucket}",
+            gen_practice_tasks, topic, session.get_subject(), session.get_grade(), score,
+        )
 
-    st.markdown('<div class="progress-card">', unsafe_allow_html=True)
-    st.markdown("### 📊 Результаты тестирования")
 
-    correct_count = 0
-    for i, q in enumerate(qs):
-        got = answers.get(i)
-        expected = q.get("correct_answer", "A")
-        if compare_answers(got, expected):
-            correct_count += 1
-            st.markdown('<div class="success-animation">', unsafe_allow_html=True)
-            st.success(f"Вопрос {i+1}: Правильно!")
-            st.markdown("</div>", unsafe_allow_html=True)
-        else:
-            st.error(f"Вопрос {i+1}: Неправильно")
-            exp = q.get("explanation", "")
-            if exp:
-                st.caption(f"Объяснение: {exp}")
+def show_theory_results(session: SessionManager):
+    theory = st.session_state.theory
+    qs = theory["questions"]
+    verdicts = theory["verdicts"]
+    score = theory["score"]
 
-    score = calculate_score(correct_count, len(qs))
-    st.metric("Ваш результат", f"{correct_count}/{len(qs)} ({score:.0f}%)")
-    session.save_theory_score(topic_key, score)
+    with st.container(border=True):
+        st.markdown("### 📊 Результаты тестирования")
 
-    pass_bar = APP_CONFIG.get("theory_pass_threshold", 60)
-    if score < pass_bar:
-        st.warning(f"Проходной порог: {pass_bar}%. Рекомендуем пересмотреть видео.")
+        # весь разбор — один элемент: строка HTML на вопрос вместо 2–3 элементов на каждый
+        rows = []
+        for i, (q, ok) in enumerate(zip(qs, verdicts)):
+            if ok:
+                rows.append(f'<div class="result-ok success-animation">✅ Вопрос {i+1}: Правильно!</div>')
+            else:
+                exp = q.get("explanation", "")
+                note = f"<small>Объяснение: {html.escape(exp)}</small>" if exp else ""
+                rows.append(f'<div class="result-bad">❌ Вопрос {i+1}: Неправильно{note}</div>')
+        st.markdown("".join(rows), unsafe_allow_html=True)
 
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("Пересмотреть урок"):
-            session.clear_theory_data()
-            session.set_stage("video")
-            st.rerun()
-    with col2:
-        if st.button("Начать практику", type="primary"):
-            session.clear_theory_data()
-            session.set_stage("practice")
-            st.rerun()
+        st.metric("Ваш результат", f"{sum(verdicts)}/{len(qs)} ({score:.0f}%)")
+
+        pass_bar = APP_CONFIG.get("theory_pass_threshold", 60)
+        if score < pass_bar:
+            st.warning(f"Проходной порог: {pass_bar}%. Рекомендуем пересмотреть видео.")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Пересмотреть урок"):
+                session.clear_theory_data()
+                session.set_stage("video")
+                st.rerun()
+        with col2:
+            if st.button("Начать практику", type="primary"):
+                session.clear_theory_data()
+                session.set_stage("practice")
+                st.rerun()
 
-    st.markdown("</div>", unsafe_allow_html=True)
 
 
 def show_practice_stage(session: SessionManager):
@@ -612,82 +1476,109 @@ def show_practice_stage(session: SessionManager):
         unsafe_allow_html=True,
     )
 
-    if "practice_tasks" not in st.session_state:
+    ss = st.session_state
+    # всё состояние практики — под одним ключом: одна проверка наличия и один сброс
+    practice = ss.get("practice")
+    if practice is None:
         with st.spinner("Генерация заданий..."):
             theory_score = session.get_theory_score(topic)
-            data = gen_practice_tasks(topic, subject, grade, theory_score)
+            bucket = _perf_bucket(theory_score)
+            data = None
+            if bucket == 0:
+                data = ss.get("lesson_practice", {}).get(topic_key)
+            if not _has_tasks(data):
+                data = _take_generation(f"practice:{topic_key}:{bucket}")
+            if not isinstance(data, dict) or data.get("error"):
+                data = gen_practice_tasks(topic, subject, grade, theory_score)
             if isinstance(data, dict) and data.get("error"):
                 st.error("Не удалось сгенерировать задания.")
-                st.session_state.practice_tasks = {"easy": [], "medium": [], "hard": []}
-            else:
-                st.session_state.practice_tasks = data or {"easy": [], "medium": [], "hard": []}
-            st.session_state.task_attempts = {}
-            st.session_state.completed_tasks = []
-            st.session_state.current_task_type = "easy"
-            st.session_state.current_task_index = 0
+                data = None
+            # уровни складываем в один плоский список; offsets — где кончается каждый уровень,
+            # уровень текущего задания находится бинарным поиском по номеру
+            tasks, offsets = [], []
+            for t in _TASK_TYPES:
+                items = data.get(t) if isinstance(data, dict) else None
+                if isinstance(items, list):
+                    tasks.extend(items)
+                offsets.append(len(tasks))
+            ss.practice = practice = {
+                "tasks": tasks,
+                "offsets": tuple(offsets),
+                "total": len(tasks),
+                "pos": 0,
+                "done": 0,
+                "completed": set(),
+                "attempts": {},
+                "hints": {},
+            }
 
-    if any(len(st.session_state.practice_tasks.get(t, [])) for t in ["easy", "medium", "hard"]):
+    if practice["total"]:
         show_current_task(session)
     else:
         st.error("Нет заданий. Попробуйте позже.")
 
 
+# Фрагмент: клики внутри карточки задания перезапускают только её, а не весь скрипт
+# (сайдбар с графиком, заголовки и т.д. остаются как есть).
+@st.fragment
 def show_current_task(session: SessionManager):
     tutor_cfg = APP_CONFIG
-    task_types = ["easy", "medium", "hard"]
-    ttype = st.session_state.current_task_type
-    idx = st.session_state.current_task_index
-    tasks_of_type = st.session_state.practice_tasks.get(ttype, [])
-
-    if idx >= len(tasks_of_type):
-        ti = task_types.index(ttype)
-        if ti < len(task_types) - 1:
-            st.session_state.current_task_type = task_types[ti + 1]
-            st.session_state.current_task_index = 0
-            st.rerun()
-        else:
-            show_practice_completion(session)
-            return
+    # session_state хранит объекты по ссылке — берём их один раз, без повторных обращений к прокси
+    practice = st.session_state.practice
+    practice_tasks = practice["tasks"]
+    pos = practice["pos"]
 
-    task = tasks_of_type[idx]
+    if pos >= len(practice_tasks):
+        show_practice_completion(session)
+        return
+
+    # пустые уровни пропускаются сами: их границы совпадают с границей предыдущего
+    offsets = practice["offsets"]
+    level = bisect_right(offsets, pos)
+    ttype = _TASK_TYPES[level]
+    level_start = offsets[level - 1] if level else 0
+    idx = pos - level_start
+    task = practice_tasks[pos]
     task_key = f"{ttype}_{idx}"
 
-    total = sum(len(st.session_state.practice_tasks.get(t, [])) for t in task_types)
-    done = len(st.session_state.completed_tasks)
+    total = practice["total"]
+    done = practice["done"]
 
     col1, col2 = st.columns([3, 1])
 
     with col2:
-        st.markdown('<div class="progress-card">', unsafe_allow_html=True)
-        st.markdown("### 📊 Прогресс")
-        st.progress(done / total if total else 0)
-        st.metric("Выполнено", f"{done}/{total}")
-        label = UI_CONFIG["task_type_names"].get(ttype, ttype)
-        st.markdown(f'<span class="difficulty-badge {ttype}">{label}</span>', unsafe_allow_html=True)
-        st.markdown(f"**Задание:** {idx+1} из {len(tasks_of_type)}")
-        st.markdown("</div>", unsafe_allow_html=True)
-
-    with col1:
-        st.markdown(
-            f'<div class="task-card"><span class="difficulty-badge {ttype}">{UI_CONFIG["task_type_names"].get(ttype, ttype)}</span>',
-            unsafe_allow_html=True,
-        )
-        st.markdown(f"### Задание {idx+1}")
-        st.markdown(task.get("question", ""), unsafe_allow_html=True)
-
-        user_answer = st.text_input("Ваш ответ:", key=f"answer_{task_key}")
-        attempts = st.session_state.task_attempts.get(task_key, 0)
+        with st.container(border=True):
+            st.markdown("### 📊 Прогресс")
+            st.progress(done / total if total else 0)
+            st.metric("Выполнено", f"{done}/{total}")
+            # бейдж и текст карточки — одним элементом каждый, а не отдельным st.markdown на строку
+            badge = f'<span class="difficulty-badge {ttype}">{_TASK_TYPE_NAMES.get(ttype, ttype)}</span>'
+            st.markdown(f"{badge}\n\n**Задание:** {idx+1} из {offsets[level] - level_start}", unsafe_allow_html=True)
+
+    with col1, st.container(border=True):
+        st.markdown(f"{badge}\n\n### Задание {idx+1}\n\n{task.get('question', '')}", unsafe_allow_html=True)
+
+        attempts = practice["attempts"].get(task_key, 0)
         max_att = tutor_cfg["max_attempts_per_task"]
 
-        if attempts < max_att:
-            col_a, col_b = st.columns(2)
-            with col_a:
-                if st.button("Проверить ответ", type="primary", key=f"check_{task_key}"):
-                    check_answer(session, task, user_answer, task_key)
-            with col_b:
-                if st.button("Пропустить", key=f"skip_{task_key}"):
-                    log_user_action("skip_task", {"task_key": task_key})
-                    move_to_next_task()
+        # итог задания хранится в состоянии, а не в ветке нажатой кнопки: иначе кнопка
+        # «Следующее задание» пропала бы при первом же перезапуске фрагмента и клик потерялся
+        if task_key in practice["completed"]:
+            st.success("Правильно! Отличная работа.")
+            if st.button("Следующее задание", key=f"next_{task_key}", type="primary"):
+                move_to_next_task()
+        elif attempts < max_att:
+            # форма: ввод ответа не перезапускает фрагмент, только кнопки отправки
+            with st.form(f"task_form_{task_key}", border=False):
+                user_answer = st.text_input("Ваш ответ:", key=f"answer_{task_key}")
+                col_a, col_b = st.columns(2)
+                check = col_a.form_submit_button("Проверить ответ", type="primary")
+                skip = col_b.form_submit_button("Пропустить")
+            if check:
+                check_answer(session, task, user_answer, task_key)
+            elif skip:
+                log_user_action("skip_task", {"task_key": task_key})
+                move_to_next_task()
         else:
             st.error(f"Все попытки ({max_att}) исчерпаны.")
             if task.get("answer"):
@@ -698,17 +1589,16 @@ def show_current_task(session: SessionManager):
                 move_to_next_task()
 
         # Подсказки
-        if task_key in st.session_state and "hints" in st.session_state[task_key]:
+        hints = practice["hints"].get(task_key)
+        if hints:
             st.markdown("### 💡 Подсказки:")
-            for hint in st.session_state[task_key]["hints"]:
+            for hint in hints:
                 st.info(hint)
 
-        st.markdown("</div>", unsafe_allow_html=True)
-
 
 def check_answer(session: SessionManager, task: dict, user_answer: str, task_key: str):
-    st.session_state.task_attempts[task_key] = st.session_state.task_attempts.get(task_key, 0) + 1
-    attempts = st.session_state.task_attempts[task_key]
+    practice = st.session_state.practice
+    attempts = practice["attempts"][task_key] = practice["attempts"].get(task_key, 0) + 1
     max_attempts = APP_CONFIG["max_attempts_per_task"]
 
     is_correct = compare_answers(
@@ -717,51 +1607,44 @@ def check_answer(session: SessionManager, task: dict, user_answer: str, task_key
     )
 
     if is_correct:
-        st.markdown('<div class="success-animation">', unsafe_allow_html=True)
-        st.success("Правильно! Отличная работа.")
-        st.markdown("</div>", unsafe_allow_html=True)
-        if task_key not in st.session_state.completed_tasks:
-            st.session_state.completed_tasks.append(task_key)
+        if task_key not in practice["completed"]:
+            practice["completed"].add(task_key)
+            practice["done"] += 1
         log_user_action("correct_answer", {"task_key": task_key, "attempts": attempts})
-        if st.button("Следующее задание", key=f"next_{task_key}"):
-            move_to_next_task()
+        # карточка перерисуется в состоянии «решено» — с кнопкой перехода
+        st.rerun(scope="fragment")
     else:
         if attempts < max_attempts:
             st.error(f"Неправильно. Попытка {attempts} из {max_attempts}")
-            # делаем короткую подсказку
-            hint = "Подумай, какой шаг в вычислениях мог быть сделан неверно."  # fallback
-            try:
-                hint_resp = call_llm(
-                    f"""
+            # делаем короткую подсказку; текст выводится по мере генерации
+            fallback = "Подумай, какой шаг в вычислениях мог быть сделан неверно."
+            placeholder = st.empty()
+            parts = []
+            for piece in stream_llm_text(
+                f"""
 Студент решал задачу: "{task.get('question','')}"
 Правильный ответ: "{task.get('answer','')}"
 Ответ студента: "{user_answer}"
 Дай краткую подсказку (1–2 предложения), без LaTeX и без полного решения.
-"""
-                )
-                if isinstance(hint_resp, dict) and "content" in hint_resp:
-                    hint = str(hint_resp["content"]).strip() or hint
-            except Exception:
-                pass
-
-            if task_key not in st.session_state:
-                st.session_state[task_key] = {"hints": []}
-            st.session_state[task_key]["hints"].append(hint)
-            st.info(f"Подсказка: {hint}")
+""",
+                max_tokens=DEEPSEEK_CONFIG.get("max_tokens_hint", 200),
+            ):
+                parts.append(piece)
+                placeholder.info(f"Подсказка: {''.join(parts)}")
+            hint = "".join(parts).strip() or fallback
+            # в список подсказок — только готовый текст
+            practice["hints"].setdefault(task_key, []).append(hint)
+            placeholder.info(f"Подсказка: {hint}")
             log_user_action("incorrect_answer", {"task_key": task_key, "attempts": attempts})
         else:
-            st.error("Все попытки исчерпаны.")
-            if task.get("answer"):
-                st.info(f"**Правильный ответ:** {task['answer']}")
-            if task.get("solution"):
-                st.caption(f"Решение: {task['solution']}")
-            if st.button("Следующее задание", key=f"next_limit_{task_key}"):
-                move_to_next_task()
+            log_user_action("incorrect_answer", {"task_key": task_key, "attempts": attempts})
+            # попытки кончились — карточка перерисуется с ответом и кнопкой перехода
+            st.rerun(scope="fragment")
 
 
 def move_to_next_task():
-    st.session_state.current_task_index += 1
-    st.rerun()
+    st.session_state.practice["pos"] += 1
+    st.rerun(scope="fragment")
 
 
 def show_practice_completion(session: SessionManager):
@@ -773,37 +1656,44 @@ def show_practice_completion(session: SessionManager):
     current_video = videos[session.get_current_video_index()]
     topic_key = f"{session.get_subject()}_{session.get_grade()}_{current_video['title']}"
 
-    st.markdown('<div class="progress-card">', unsafe_allow_html=True)
-    st.header("Практика завершена!")
-
-    total = sum(len(st.session_state.practice_tasks.get(t, [])) for t in ["easy", "medium", "hard"])
-    done = len(st.session_state.completed_tasks)
-    score = calculate_score(done, total) if total else 0.0
-    st.success(f"Выполнено {done} из {total} заданий ({score:.0f}%)")
-
-    session.save_practice_score(topic_key, done, total)
-
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("Изучить новую тему"):
-            if session.next_video():
-                session.set_stage("video")
-                for k in ["practice_tasks", "task_attempts", "completed_tasks", "current_task_type", "current_task_index"]:
-                    if k in st.session_state:
-                        del st.session_state[k]
+    with st.container(border=True):
+        st.header("Практика завершена!")
+
+        practice = st.session_state.practice
+        total, done = practice["total"], practice["done"]
+        score = calculate_score(done, total) if total else 0.0
+        st.success(f"Выполнено {done} из {total} заданий ({score:.0f}%)")
+
+        # карточка перерисовывается на каждый клик — пишем результат только один раз;
+        # отметка живёт в состоянии практики и исчезает вместе с ним
+        saved = (topic_key, done, total)
+        if practice.get("saved") != saved:
+            session.save_practice_score(topic_key, done, total)
+            practice["saved"] = saved
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Изучить новую тему"):
+                if session.next_video() or (get_tutor().load_more_videos(session) and session.next_video()):
+                    session.set_stage("video")
+                    session.clear_practice_data()
+                    st.rerun()
+                else:
+                    st.info("Все темы курса пройдены!")
+        with col2:
+            if st.button("Вернуться к выбору курса"):
+                session.set_stage("selection")
+                session.clear_practice_data()
                 st.rerun()
-            else:
-                st.info("Все темы курса пройдены!")
-    with col2:
-        if st.button("Вернуться к выбору курса"):
-            session.set_stage("selection")
-            for k in ["practice_tasks", "task_attempts", "completed_tasks", "current_task_type", "current_task_index"]:
-                if k in st.session_state:
-                    del st.session_state[k]
-            st.rerun()
-
-    st.markdown(generate_progress_report(session.get_progress(), topic_key), unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
+
+        # отчёт зависит только от прогресса — пересобираем его, как и график, по версии прогресса
+        report_key = (session.get_progress_version(), topic_key)
+        memo = st.session_state.get("_progress_report")
+        if memo is None or memo[0] != report_key:
+            report = generate_progress_report(session.get_progress(), topic_key)
+            memo = st.session_state["_progress_report"] = (report_key, report)
+        with st.expander("Отчёт о прогрессе"):
+            st.markdown(memo[1], unsafe_allow_html=True)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -46,7 +46,12 @@ PLAYLISTS = {
 }
 
 APP_CONFIG = {
+    # Размер страницы плейлиста (максимум API — 50); следующие страницы догружаются по ходу курса
     "youtube_max_results": 50,
+    # При старте сервера параллельно подгрузить все плейлисты (по запросу квоты YouTube на каждый)
+    "warm_playlists": True,
+    # Сколько секунд держать страницу плейлиста в кэше; после истечения — условный GET по ETag
+    "playlist_cache_ttl": 6 * 3600,
 
     # Теория: просим 10, но если модель даст меньше — допускаем минимум (например, 6)
     "theory_questions_count": 10,
@@ -55,6 +60,14 @@ APP_CONFIG = {
     "tasks_per_difficulty": {"easy": 3, "medium": 3, "hard": 2},
     "max_attempts_per_task": 3,
     "theory_pass_threshold": 60,
+
+    # Фоновая генерация теста к текущему уроку, пока смотрится видео
+    "prefetch_current_test": True,
+    # Фоновая генерация вопросов к следующему уроку, пока смотрится текущий (тратит токены)
+    "prefetch_next_lesson": True,
+
+    # Теория и практика одним запросом к LLM (практика из него — для среднего балла теории)
+    "bundle_lesson_generation": True,
     "progress_file": "progress.json",
 }
 
@@ -66,15 +79,29 @@ DEEPSEEK_CONFIG = {
     "max_tokens": 2000,              # дефолт
     "max_tokens_theory": 3400,       # 10 вопросов с объяснениями
     "max_tokens_practice": 2800,     # набор практик
+    "max_tokens_lesson": 6000,       # теория + практика одним запросом
+    "max_tokens_hint": 200,          # подсказка в 1–2 предложения
 
     # Таймауты
     "timeout": 60,
     "timeout_theory": 45,
     "timeout_practice": 40,
 
+    # Сколько секунд держать сгенерированные вопросы/задания в кэше процесса
+    "llm_cache_ttl": 7 * 24 * 3600,
+    # Дисковый кэш генераций (переживает перезапуск сервера); None — выключен
+    "lesson_store_dir": ".cache/lessons",
+    "lesson_store_ttl": 30 * 24 * 3600,
+
     # Повторы
     "retry_attempts": 3,
     "theory_topup_retries": 2,       # сколько раз «доделывать» недостающие вопросы
+
+    # gzip для тел запросов длиннее 1 КБ; включать, только если API принимает Content-Encoding: gzip
+    "compress_requests": False,
+
+    # Параллельные запросы (дозапросы вопросов, уровни практики) — не больше, чтобы не упереться в rate limit
+    "max_parallel": 3,
 }
 
 UI_CONFIG = {
@@ -1,11 +1,12 @@
 # utils.py
+import atexit
 import os
 import json
 import re
+import threading
 from datetime import datetime
+from functools import lru_cache
 
-import pandas as pd
-import plotly.express as px
 import streamlit as st
 
 from config import APP_CONFIG, UI_CONFIG
@@ -13,6 +14,33 @@ from config import APP_CONFIG, UI_CONFIG
 
 # ================== Сравнение ответов ==================
 
+# регулярки компилируем один раз при импорте, а не на каждый ответ
+_WS_RE = re.compile(r"\s+")
+_PARENS_RE = re.compile(r"[()]+")
+_CLAUSE_SPLIT_RE = re.compile(r"(?:and|or|,|;)")
+_INEQUALITY_OPS = (">=", "<=", ">", "<")
+_INTERVAL_CHARS = ("[", "]", "(", ")")
+_CHOICE_LETTERS = frozenset(("a", "b", "c", "d"))
+
+
+def _replace_textual_operators(text):
+    text = text.replace("больше или равно", ">=")
+    text = text.replace("меньше или равно", "<=")
+    text = text.replace("больше", ">")
+    text = text.replace("меньше", "<")
+    return text
+
+
+def _normalize_answer(answer):
+    answer = _WS_RE.sub("", answer)
+    answer = answer.replace("infinity", "inf")
+    answer = _PARENS_RE.sub("", answer)
+    return answer
+
+
+# чистая функция от двух коротких строк: повторная проверка того же ответа (повторный
+# клик, повторный ответ на попытке) не гоняет регулярки заново
+@lru_cache(maxsize=1024)
 def compare_answers(user_answer, correct_answer):
     """
     Сравнивает ответ пользователя с правильным, учитывая числа, множества, неравенства и текстовые ошибки.
@@ -20,36 +48,26 @@ def compare_answers(user_answer, correct_answer):
     """
     user_answer = str(user_answer or "").strip().lower()
     correct_answer = str(correct_answer or "").strip().lower()
+    # частый случай — ответ совпал дословно; нормализация и регулярки не нужны
+    if user_answer == correct_answer:
+        return True
 
-    def replace_textual_operators(text):
-        text = text.replace("больше или равно", ">=")
-        text = text.replace("меньше или равно", "<=")
-        text = text.replace("больше", ">")
-        text = text.replace("меньше", "<")
-        return text
-
-    user_answer = replace_textual_operators(user_answer)
-    correct_answer = replace_textual_operators(correct_answer)
-
-    def normalize_answer(answer):
-        answer = re.sub(r"\s+", "", answer)
-        answer = answer.replace("infinity", "inf")
-        answer = re.sub(r"[()]+", "", answer)
-        return answer
+    user_answer = _replace_textual_operators(user_answer)
+    correct_answer = _replace_textual_operators(correct_answer)
 
-    user_answer_norm = normalize_answer(user_answer)
-    correct_answer_norm = normalize_answer(correct_answer)
+    user_answer_norm = _normalize_answer(user_answer)
+    correct_answer_norm = _normalize_answer(correct_answer)
 
     # неравенства: "x>=2, x<5" и т.п.
-    if any(op in user_answer_norm for op in [">=", "<=", ">", "<"]):
-        user_parts = re.split(r"(?:and|or|,|;)", user_answer_norm)
-        correct_parts = re.split(r"(?:and|or|,|;)", correct_answer_norm)
+    if any(op in user_answer_norm for op in _INEQUALITY_OPS):
+        user_parts = _CLAUSE_SPLIT_RE.split(user_answer_norm)
+        correct_parts = _CLAUSE_SPLIT_RE.split(correct_answer_norm)
         user_parts = sorted([p for p in user_parts if p])
         correct_parts = sorted([p for p in correct_parts if p])
         return user_parts == correct_parts
 
     # интервалы: [2, inf)
-    if any(c in (user_answer or "") for c in ["[", "]", "(", ")"]):
+    if any(c in user_answer for c in _INTERVAL_CHARS):
         return user_answer.replace(" ", "") == correct_answer.replace(" ", "")
 
     # множества через запятую (порядок не важен)
@@ -68,7 +86,7 @@ def compare_answers(user_answer, correct_answer):
             pass
 
     # множественный выбор
-    if correct_answer_norm in ["a", "b", "c", "d"]:
+    if correct_answer_norm in _CHOICE_LETTERS:
         return user_answer_norm == correct_answer_norm or user_answer_norm == correct_answer_norm[0]
 
     return user_answer_norm == correct_answer_norm
@@ -94,15 +112,17 @@ def generate_progress_report(progress_data, topic_key):
     return report
 
 
+SUBJECT_EMOJIS = {
+    "Алгебра": "🔢",
+    "Геометрия": "📐",
+    "Физика": "⚛️",
+    "Химия": "🧪",
+    "Английский язык": "🇬🇧",
+}
+
+
 def get_subject_emoji(subject):
-    emojis = {
-        "Алгебра": "🔢",
-        "Геометрия": "📐",
-        "Физика": "⚛️",
-        "Химия": "🧪",
-        "Английский язык": "🇬🇧",
-    }
-    return emojis.get(subject, "📚")
+    return SUBJECT_EMOJIS.get(subject, "📚")
 
 
 # =============== Санитайзинг вопросов теории ===============
@@ -170,18 +190,14 @@ class SessionManager:
         self.user_id = user_id
         self.progress_file = APP_CONFIG["progress_file"]
 
-        if "progress" not in st.session_state:
-            st.session_state.progress = self.load_progress()
-        if "current_stage" not in st.session_state:
-            st.session_state.current_stage = "selection"
-        if "videos" not in st.session_state:
-            st.session_state.videos = []
-        if "current_video_index" not in st.session_state:
-            st.session_state.current_video_index = 0
-        if "selected_subject" not in st.session_state:
-            st.session_state.selected_subject = None
-        if "selected_grade" not in st.session_state:
-            st.session_state.selected_grade = None
+        ss = st.session_state
+        if "progress" not in ss:
+            ss.progress = self.load_progress()
+        ss.setdefault("current_stage", "selection")
+        ss.setdefault("videos", [])
+        ss.setdefault("current_video_index", 0)
+        ss.setdefault("selected_subject", None)
+        ss.setdefault("selected_grade", None)
 
     # ---------- прогресс ----------
     def load_progress(self):
@@ -211,24 +227,48 @@ class SessionManager:
         return st.session_state.selected_grade
 
     # ---------- видео ----------
-    def start_course(self, videos):
+    def start_course(self, videos, next_page_token=None, playlist_id=None):
         st.session_state.videos = videos
-        completed_titles = [
+        # токен страницы действителен только для своего плейлиста: храним их вместе, а не
+        # выводим плейлист из предмета/класса — их перезаписывает сайдбар на каждом rerun
+        st.session_state.videos_playlist = playlist_id
+        st.session_state.videos_next_page = next_page_token
+        st.session_state.current_stage = "video"
+        return self.resume_course()
+
+    def resume_course(self):
+        """
+        Делает текущим первый непройденный урок среди загруженных. Если пройдены все
+        загруженные — встаём на последний и возвращаем False: вызывающий может догрузить
+        следующую страницу плейлиста и вызвать метод снова.
+        """
+        prefix = f"{self.get_subject()}_{self.get_grade()}_"
+        completed_titles = {
             t.split("_", 2)[-1]
             for t in st.session_state.progress["completed_topics"]
-            if t.startswith(f"{self.get_subject()}_{self.get_grade()}_")
-        ]
-        start_index = 0
+            if t.startswith(prefix)
+        }
+        videos = st.session_state.videos
         for i, video in enumerate(videos):
             if video["title"] not in completed_titles:
-                start_index = i
-                break
-        st.session_state.current_video_index = start_index
-        st.session_state.current_stage = "video"
+                st.session_state.current_video_index = i
+                return True
+        st.session_state.current_video_index = max(len(videos) - 1, 0)
+        return False
 
     def get_videos(self):
         return st.session_state.videos
 
+    def get_next_page_token(self):
+        return st.session_state.get("videos_next_page")
+
+    def get_playlist_id(self):
+        return st.session_state.get("videos_playlist")
+
+    def extend_videos(self, videos, next_page_token):
+        st.session_state.videos.extend(videos)
+        st.session_state.videos_next_page = next_page_token
+
     def get_current_video_index(self):
         return st.session_state.current_video_index
 
@@ -258,6 +298,7 @@ class SessionManager:
             st.session_state.progress["scores"][topic_key] = {}
         st.session_state.progress["scores"][topic_key]["theory_score"] = score
         st.session_state.progress["scores"][topic_key]["date"] = datetime.now().isoformat()
+        self._bump_progress_version()
         self.save_progress()
 
     def save_practice_score(self, topic_key, completed, total):
@@ -268,8 +309,16 @@ class SessionManager:
         st.session_state.progress["scores"][topic_key]["practice_completed"] = completed
         st.session_state.progress["scores"][topic_key]["practice_total"] = total
         st.session_state.progress["scores"][topic_key]["date"] = datetime.now().isoformat()
+        self._bump_progress_version()
         self.save_progress()
 
+    def _bump_progress_version(self):
+        # по версии UI понимает, что производные от прогресса (график) пора пересчитать
+        st.session_state.progress_version = st.session_state.get("progress_version", 0) + 1
+
+    def get_progress_version(self):
+        return st.session_state.get("progress_version", 0)
+
     def get_theory_score(self, video_title):
         topic_key = f"{self.get_subject()}_{self.get_grade()}_{video_title}"
         return st.session_state.progress["scores"].get(topic_key, {}).get("theory_score", None)
@@ -286,28 +335,28 @@ class SessionManager:
         return "medium"
 
     def clear_theory_data(self):
-        for key in ["theory_questions", "theory_answers"]:
-            if key in st.session_state:
-                del st.session_state[key]
+        st.session_state.pop("theory", None)
+        # радио-кнопки хранят только букву, поэтому выбор пережил бы смену вопросов
+        for key in [k for k in st.session_state if str(k).startswith("theory_q_")]:
+            del st.session_state[key]
 
     def clear_practice_data(self):
-        for key in [
-            "practice_tasks",
-            "task_attempts",
-            "completed_tasks",
-            "current_task_type",
-            "current_task_index",
-        ]:
-            if key in st.session_state:
-                del st.session_state[key]
+        st.session_state.pop("practice", None)
+        # поля ответов привязаны к ключу задания ("easy_0", ...) — иначе текст перешёл бы в новую тему
+        for key in [k for k in st.session_state if str(k).startswith("answer_")]:
+            del st.session_state[key]
 
 
 # ================== График прогресса ==================
 
 def create_progress_chart_data(progress_data):
+    """Таблица для st.bar_chart: тема и два процента; None, если оценок ещё нет."""
     scores = progress_data.get("scores", {})
     if not scores:
         return None
+    # pandas нужен только для графика — не грузим его при старте, пока оценок нет
+    import pandas as pd
+
     data = []
     for topic_key, score_info in scores.items():
         subject, grade, topic = topic_key.split("_", 2)
@@ -324,27 +373,62 @@ def create_progress_chart_data(progress_data):
                 "Дата": score_info.get("date", "N/A"),
             }
         )
-    df = pd.DataFrame(data)
-    fig = px.bar(
-        df,
-        x="Тема",
-        y=["Теория (%)", "Практика (%)"],
-        barmode="group",
-        title="Прогресс по темам",
-        height=300,
-    )
-    fig.update_layout(yaxis_title="Результат (%)", legend_title="Тип", margin=dict(t=50, b=50))
-    return fig
+    return pd.DataFrame(data)
 
 
 # ================== Логирование ==================
 
+# События копятся в памяти процесса, а в файл их дописывает фоновый поток: раз в
+# LOG_MAX_DELAY секунд или сразу, как набралось LOG_BATCH событий. Клик ученика платит
+# только за json.dumps и append — открытие файла и запись идут вне прогона скрипта.
+_LOG_FILE = "user_actions.log"
+_LOG_BATCH = 32
+_LOG_MAX_DELAY = 5.0
+
+_log_buffer = []
+_log_lock = threading.Lock()
+# отдельный замок на запись: клики не ждут диск, а пачки ложатся в файл по порядку
+_log_write_lock = threading.Lock()
+_log_wakeup = threading.Event()
+
+
+def flush_user_actions():
+    """Дописывает накопленные события в лог; вызывается фоновым потоком, но можно и вручную."""
+    with _log_write_lock:
+        with _log_lock:
+            if not _log_buffer:
+                return
+            lines = "".join(_log_buffer)
+            _log_buffer.clear()
+        try:
+            with open(_LOG_FILE, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except Exception:
+            pass
+
+
+def _log_writer():
+    while True:
+        _log_wakeup.wait(_LOG_MAX_DELAY)
+        _log_wakeup.clear()
+        flush_user_actions()
+
+
+threading.Thread(target=_log_writer, name="user-actions-log", daemon=True).start()
+
+
 def log_user_action(action, details):
     log_entry = {"timestamp": datetime.now().isoformat(), "action": action, "details": details}
-    log_file = "user_actions.log"
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            json.dump(log_entry, f, ensure_ascii=False)
-            f.write("\n")
+        line = json.dumps(log_entry, ensure_ascii=False) + "\n"
     except Exception:
-        pass
+        return
+    with _log_lock:
+        _log_buffer.append(line)
+        full = len(_log_buffer) >= _LOG_BATCH
+    if full:
+        _log_wakeup.set()
+
+
+# при остановке сервера дописываем хвост
+atexit.register(flush_user_actions)